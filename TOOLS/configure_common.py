@@ -1,6 +1,13 @@
 #!/usr/bin/env python3
 import atexit
+import concurrent.futures
+import functools
+import hashlib
+import io
+import itertools
+import json
 import os
+import re
 import shutil
 import subprocess
 import sys
@@ -9,6 +16,14 @@ import tempfile
 NoneType = type(None)
 function = type(lambda: 0)
 
+# Snapshot of the environment; configure only reads it, so there's no need to
+# go through os.environ (which re-encodes keys on every access).
+_environ = dict(os.environ)
+
+# PATH lookups stat() every PATH entry, and the same binaries (CC, ccache) are
+# looked up repeatedly.
+_which = functools.lru_cache(maxsize = None)(shutil.which)
+
 programs_info = [
     # env. name     default
     ("CC",          "cc"),
@@ -44,9 +59,12 @@ class _G:
     log_file = None     # opened log file
 
     temp_path = None    # set to a private, writable temporary directory
+    test_outfile = None # output file for check_cc() (in temp_path)
+    temp_files = set()  # files that may have been created in temp_path
     build_dir = None
     root_dir = None
     out_of_tree = False
+    clean_build = False # set if --clean is specified on the command line
 
     install_paths = {}  # var name to path, see install_paths_info
 
@@ -58,13 +76,19 @@ class _G:
     cflags = []
     ldflags = []
 
-    config_h = ""       # new contents of config.h (written at the end)
-    config_mak = ""     # new contents of config.mak (written at the end)
+    config_h = io.StringIO()    # new contents of config.h (written at the end)
+    config_mak = io.StringIO()  # new contents of config.mak (written at the end)
 
-    sources = []
+    sources = {}        # source files added so far; used as an ordered set,
+                        # the values are unused
 
     state_stack = []
 
+    probe_cache = None  # check_cc() results from a previous run, keyed by
+                        # _probe_key(); None if --config-cache wasn't given
+    probe_cache_used = {} # results looked up or added by this run; only
+                          # these are written back to the cache file
+
     feature_opts = {}   # keyed by option name, values are:
                         #   "yes": force enable, like --enable-<feature>
                         #   "no": force disable, like: --disable-<feature>
@@ -74,6 +98,16 @@ class _G:
     dep_enabled = {}    # keyed by dependency identifier; value is a bool
                         # missing key means the check was not run yet
 
+    unchecked_deps = [] # dependency identifiers whose existence is verified
+                        # by _validate_dep_ids() in finish()
+
+    have_ccache = None  # result of _check_ccache(), None if not run yet
+
+    cc_predefines = None # macros predefined by CC (name to value), queried
+                         # on first use by get_cc_define()
+
+    pkg_config_exists = {} # check_pkg_config_exists() results, keyed by args
+
 
 # Convert a string to a C string literal. Adds the required "".
 def _c_quote_string(s):
@@ -94,29 +128,82 @@ def die(msg):
     sys.stderr.write("Not updating build files.\n")
     if _G.log_file:
         _G.log_file.write("--- Stopping due to error: %s\n" % msg)
+        _G.log_file.flush()
     sys.exit(1)
 
+def _opt_noval(name, val):
+    if val:
+        die("Option --%s does not take a value." % name)
+
+# Feature option names use "-" instead of "_" (see check()). Normalize names
+# given on the command line, so e.g. --enable-foo_bar works too.
+_opt_name_table = str.maketrans("_", "-")
+
+def _opt_enable(name, val):
+    _opt_noval(name, val)
+    _G.feature_opts[name[7:].translate(_opt_name_table)] = "yes"
+
+def _opt_disable(name, val):
+    _opt_noval(name, val)
+    _G.feature_opts[name[8:].translate(_opt_name_table)] = "no"
+
+def _opt_with(name, val):
+    if val not in ["yes", "no", "auto", "default"]:
+        die("Option --%s requires 'yes', 'no', 'auto', or 'default'." % name)
+    _G.feature_opts[name[5:].translate(_opt_name_table)] = val
+
+# Command line option prefixes for feature options, and their handlers.
+_feature_opt_prefixes = (
+    ("enable-",     _opt_enable),
+    ("disable-",    _opt_disable),
+    ("with-",       _opt_with),
+)
+
+# Install paths which can be set with --<lowercase name>=PATH.
+_install_path_names = frozenset(["PROJNAME"] +
+                                [var for var, _ in install_paths_info])
+
+# Matches a valid C identifier.
+_ident_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Matches a "PROJNAME = name" assignment in the Makefile.
+_projname_re = re.compile(rb'^[ \t]*PROJNAME[ \t]*[:?]?=[ \t]*"?([^"\s]+)',
+                          re.MULTILINE)
+
+# Matches a shared library path, including versioned ones like libfoo.so.2.
+_shlib_re = re.compile(r'\.so(\.\d+)*$')
+
+# Matches a $(NAME) variable reference in an install path.
+_make_var_re = re.compile(r"\$\(([^)]+)\)")
+
+# Used to turn a feature name into a HAVE_ define.
+_nonalnum_re = re.compile(r'[^A-Za-z0-9]')
+_leading_bad_re = re.compile(r'^[^A-Za-z_]+')
+
+# Matches the WL_PROTO_DIR assignment in config.mak.
+_wl_proto_dir_re = re.compile(r'^WL_PROTO_DIR\s*=\s*(.+)$', re.MULTILINE)
+
+def _set_install_path(name, val):
+    _G.install_paths[name] = val
+
+def _set_build_path(name, val):
+    _G.build_dir = val
+
 # To be called before any user checks are performed.
 def begin():
     _G.root_dir = "."
     _G.build_dir = "build"
 
-    projname = os.environ.get("PROJNAME")
+    projname = _environ.get("PROJNAME")
     if not projname:
         try:
             makefile_path = os.path.join(_G.root_dir, "Makefile")
-            if os.path.exists(makefile_path):
-                with open(makefile_path, "r") as mf:
-                    for ln in mf:
-                        line = ln.strip()
-                        if line.startswith("PROJNAME"):
-                            parts = line.split("=", 1)
-                            if len(parts) == 2:
-                                projname = parts[1].strip()
-                                if projname.startswith('"') and projname.endswith('"'):
-                                    projname = projname[1:-1]
-                                projname = projname.split()[0]
-                                break
+            with open(makefile_path, "rb") as mf:
+                m = _projname_re.search(mf.read())
+            if m:
+                projname = m.group(1).decode("utf-8")
+        except FileNotFoundError:
+            pass
         except Exception:
             projname = None
     if not projname:
@@ -137,43 +224,33 @@ def begin():
             opt = name.split("=", 1)
             name = opt[0]
             val = opt[1] if len(opt) > 1 else ""
-            def noval():
-                if val:
-                    die("Option --%s does not take a value." % name)
             if name == "help":
-                noval()
+                _opt_noval(name, val)
                 _G.help_mode = True
                 continue
-            elif name.startswith("enable-"):
-                noval()
-                _G.feature_opts[name[7:]] = "yes"
+            elif name == "config-cache":
+                _opt_noval(name, val)
+                _G.probe_cache = {}
                 continue
-            elif name.startswith("disable-"):
-                noval()
-                _G.feature_opts[name[8:]] = "no"
+            elif name == "clean":
+                _opt_noval(name, val)
+                _G.clean_build = True
                 continue
-            elif name.startswith("with-"):
-                if val not in ["yes", "no", "auto", "default"]:
-                    die("Option --%s requires 'yes', 'no', 'auto', or 'default'."
-                        % name)
-                _G.feature_opts[name[5:]] = val
-                continue
-            uname = name.upper()
-            setval = None
-            if uname in _G.install_paths:
-                def set_install_path(name, val):
-                    _G.install_paths[name] = val
-                setval = set_install_path
-            elif uname == "BUILDDIR":
-                def set_build_path(name, val):
-                    _G.build_dir = val
-                setval = set_build_path
-            if not setval:
-                die("Unknown option: %s" % arg)
-            if not val:
-                die("Option --%s requires a value." % name)
-            setval(uname, val)
-            continue
+            for prefix, handler in _feature_opt_prefixes:
+                if name.startswith(prefix):
+                    handler(name, val)
+                    break
+            else:
+                uname = name.upper()
+                if uname in _install_path_names:
+                    setval = _set_install_path
+                elif uname == "BUILDDIR":
+                    setval = _set_build_path
+                else:
+                    die("Unknown option: %s" % arg)
+                if not val:
+                    die("Option --%s requires a value." % name)
+                setval(uname, val)
 
     if _G.help_mode:
         print("Environment variables controlling choice of build tools:")
@@ -193,14 +270,27 @@ def begin():
         print("")
         print("General build options:")
         print("  %-30s %s" % ("--builddir=PATH", "Build directory (default: build)"))
+        print("  %-30s %s" % ("--config-cache", "Cache compiler test results in BUILDDIR/config.cache"))
+        print("  %-30s %s" % ("--clean", "Wipe the build directory before configuring"))
         print("")
         print("Specific build configuration:")
         # check() invocations will print the options they understand.
         return
 
-    _G.temp_path = tempfile.mkdtemp(prefix = "dmpv-configure-")
+    _G.temp_path = tempfile.mkdtemp(prefix = "dmpv-configure-",
+                                    dir = _get_temp_parent_dir())
+    _G.test_outfile = os.path.join(_G.temp_path, "test")
     def _cleanup():
-        shutil.rmtree(_G.temp_path)
+        for f in _G.temp_files:
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(_G.temp_path)
+        except OSError:
+            # Something unexpected was left behind.
+            shutil.rmtree(_G.temp_path)
     atexit.register(_cleanup)
 
     # (os.path.samefile() is "UNIX only")
@@ -214,15 +304,81 @@ def begin():
         _G.root_dir = sys.path[0]
         _G.out_of_tree = True
 
-    # Wipe the build directory completely to avoid leftover files causing issues
-    if os.path.exists(_G.build_dir):
-        shutil.rmtree(_G.build_dir)
+    # Keep the build directory by default, so that objects don't need to be
+    # rebuilt if the configuration didn't change. --clean wipes it completely
+    # in case leftover files cause issues.
+    if _G.clean_build:
+        try:
+            shutil.rmtree(_G.build_dir)
+        except FileNotFoundError:
+            pass
     os.makedirs(_G.build_dir, exist_ok = True)
-    _G.log_file = open(os.path.join(_G.build_dir, "config.log"), "w")
+    log_path = os.path.join(_G.build_dir, "config.log")
+    try:
+        os.replace(log_path, log_path + ".prev")
+    except FileNotFoundError:
+        pass
+    # Almost every helper writes to the log, so use a large buffer, and write
+    # it out on exit only.
+    _G.log_file = open(log_path, "w", buffering = 1 << 20)
+    atexit.register(_G.log_file.close)
+
+    if _G.probe_cache is not None:
+        _load_probe_cache()
+
+    _G.config_h.write("// Generated by configure.\n" +
+                      "#pragma once\n\n")
+
+
+# Return where to create the temporary directory. Every check_cc() writes its
+# output there, so prefer a tmpfs, unless the user set TMPDIR. Returns None to
+# use the system default.
+def _get_temp_parent_dir():
+    if _environ.get("TMPDIR"):
+        return None
+    for d in ["/dev/shm", _environ.get("XDG_RUNTIME_DIR")]:
+        if d and os.path.isdir(d) and os.access(d, os.W_OK | os.X_OK):
+            return d
+    return None
+
+def _get_probe_cache_path():
+    return os.path.join(_G.build_dir, "config.cache")
+
+# Read the results of a previous --config-cache run. The cache is written back
+# on exit, with only the entries used by this run, so stale results from
+# earlier configurations don't accumulate.
+def _load_probe_cache():
+    try:
+        with open(_get_probe_cache_path(), "r") as f:
+            cache = json.load(f)
+        if type(cache) == dict:
+            _G.probe_cache = cache
+    except (OSError, ValueError):
+        pass
+    atexit.register(_save_probe_cache)
 
-    _G.config_h += "// Generated by configure.\n" + \
-                   "#pragma once\n\n"
+def _save_probe_cache():
+    try:
+        with open(_get_probe_cache_path(), "w") as f:
+            json.dump(_G.probe_cache_used, f)
+    except OSError:
+        pass
 
+# Return the cache key for a check_cc() invocation. This includes everything
+# that can influence the result: the test source, the command line, and the
+# mtime of the compiler binary (so toolchain upgrades invalidate the cache).
+def _probe_key(contents, flags, link, use_linking, cc_parts, cflags, ldflags):
+    cc_mtime = None
+    for part in cc_parts:
+        if os.path.basename(part) == "ccache":
+            continue
+        path = _which(part)
+        if path:
+            cc_mtime = os.stat(path).st_mtime
+        break
+    data = json.dumps([contents, flags, link, use_linking, cc_parts, cflags,
+                       ldflags, cc_mtime])
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
 
 # Check whether the first argument is the same type of any in the following
 # arguments. This _always_ returns val, but throws an exception if type checking
@@ -246,16 +402,25 @@ def normalize_list_arg(val):
     return [val]
 
 def push_build_flags():
+    # (the flags and config.h/config.mak are only appended to, so remembering
+    #  their length is enough to restore them; the programs dict is small, and
+    #  entries can be replaced, so it's copied)
     _G.state_stack.append(
-        (_G.cflags[:], _G.ldflags[:], _G.config_h, _G.config_mak,
-         _G.programs.copy()))
+        (len(_G.cflags), len(_G.ldflags), _G.config_h.tell(),
+         _G.config_mak.tell(), _G.programs.copy()))
 
 def pop_build_flags_discard():
     top = _G.state_stack[-1]
     _G.state_stack = _G.state_stack[:-1]
 
-    (_G.cflags[:], _G.ldflags[:], _G.config_h, _G.config_mak,
+    (cflags_len, ldflags_len, config_h_len, config_mak_len,
      _G.programs) = top
+    del _G.cflags[cflags_len:]
+    del _G.ldflags[ldflags_len:]
+    _G.config_h.seek(config_h_len)
+    _G.config_h.truncate()
+    _G.config_mak.seek(config_mak_len)
+    _G.config_mak.truncate()
 
 def pop_build_flags_merge():
     top = _G.state_stack[-1]
@@ -282,6 +447,10 @@ def set_exe_format(fmt):
 # preprocessor symbols, libraries, include paths, or simply serves as
 # dependency check for other checks.
 # Always call this function with named arguments.
+# Checks run immediately and strictly in order. They can't be run concurrently
+# even if they don't depend on each other: check_cc() compiles with the CFLAGS
+# and LDFLAGS accumulated by all previous checks, so the result of a check can
+# depend on what ran before it.
 # Arguments:
 #   name: String or None. Symbolic name of the check. The name can be used as
 #         dependency identifier by other checks. This is the first argument, and
@@ -334,16 +503,18 @@ def check(name = None, option = None, desc = None, deps = None, deps_any = None,
     deps_neg = normalize_list_arg(deps_neg)
     sources = normalize_list_arg(sources)
 
-    typecheck(name, str, NoneType)
-    typecheck(option, str, NoneType)
-    typecheck(desc, str, NoneType)
-    typecheck(deps, NoneType, list)
-    typecheck(deps_any, NoneType, list)
-    typecheck(deps_neg, NoneType, list)
-    typecheck(sources, NoneType, list)
-    typecheck(fn, NoneType, function)
-    typecheck(required, str, NoneType)
-    typecheck(default, bool, NoneType)
+    # (internal consistency checks; "python -O" skips them)
+    if __debug__:
+        typecheck(name, str, NoneType)
+        typecheck(option, str, NoneType)
+        typecheck(desc, str, NoneType)
+        typecheck(deps, NoneType, list)
+        typecheck(deps_any, NoneType, list)
+        typecheck(deps_neg, NoneType, list)
+        typecheck(sources, NoneType, list)
+        typecheck(fn, NoneType, function)
+        typecheck(required, str, NoneType)
+        typecheck(default, bool, NoneType)
 
     option_name = None
     define_name = None
@@ -355,7 +526,7 @@ def check(name = None, option = None, desc = None, deps = None, deps_any = None,
         if def_flag:
             name = name[:-1]
         if opt_flag:
-            option_name = name.replace("_", "-")
+            option_name = name.translate(_opt_name_table)
         if def_flag:
             define_name = "HAVE_" + name.replace("-", "_").upper()
 
@@ -382,8 +553,6 @@ def check(name = None, option = None, desc = None, deps = None, deps_any = None,
 
     _G.log_file.write("\n--- Test: %s\n" % (name if name else "(unnamed)"))
 
-    if desc:
-        sys.stdout.write("Checking for %s... " % desc)
     outcome = "yes"
 
     force_opt = required is not None
@@ -412,18 +581,20 @@ def check(name = None, option = None, desc = None, deps = None, deps_any = None,
 
     # Dependency resolution.
     # But first, check whether all dependency identifiers really exist.
-    for d in deps_neg + deps_any + deps:
-        dep_enabled(d) # discard result
+    if __debug__:
+        for d in deps_neg + deps_any + deps:
+            dep_enabled(d) # discard result
+    get_dep = _G.dep_enabled.get
     if use_dep:
         for d in deps_neg:
-            if dep_enabled(d):
+            if get_dep(d):
                 use_dep = False
                 outcome = "conflicts with %s" % d
                 break
     if use_dep:
         any_found = False
         for d in deps_any:
-            if dep_enabled(d):
+            if get_dep(d):
                 any_found = True
                 break
         if len(deps_any) > 0 and not any_found:
@@ -431,11 +602,14 @@ def check(name = None, option = None, desc = None, deps = None, deps_any = None,
             outcome = "not any of %s found" % (", ".join(deps_any))
     if use_dep:
         for d in deps:
-            if not dep_enabled(d):
+            if not get_dep(d):
                 use_dep = False
                 outcome = "%s not found" % d
                 break
 
+    if desc:
+        sys.stdout.write("Checking for %s... " % desc)
+
     # Running actual checks.
     if use_dep and fn:
         push_build_flags()
@@ -452,7 +626,8 @@ def check(name = None, option = None, desc = None, deps = None, deps_any = None,
     if define_name:
         add_config_h_define(define_name, 1 if use_dep else 0)
     if use_dep:
-        _G.sources += sources
+        for s in sources:
+            _G.sources[s] = None
     if desc:
         sys.stdout.write("%s\n" % outcome)
     _G.log_file.write("--- Outcome: %s (%s=%d)\n" %
@@ -470,26 +645,30 @@ def check(name = None, option = None, desc = None, deps = None, deps_any = None,
 # Returns the process stdout output on success, or None on non-0 exit status.
 # In particular, this logs the command and its output/exit status to the log
 # file.
-def _run_process(args):
-    p = subprocess.Popen(args, stdout = subprocess.PIPE,
-                         stderr = subprocess.PIPE,
-                         stdin = -1)
-    (p_out, p_err) = p.communicate()
-    # We don't really want this. But Python 3 in particular makes it too much of
-    # a PITA to consistently use byte strings, so we need to use "unicode" strings.
+# If input is not None, it's a string written to the process stdin.
+def _run_process(args, input = None):
     # Yes, a bad program could just blow us up here by outputting invalid UTF-8.
-    # Weakly support Python 2 too (GCC outputs UTF-8, which crashes Python 2).
-    if type(b"") != str:
-        p_out = p_out.decode("utf-8")
-        p_err = p_err.decode("utf-8")
-    status = p.wait()
+    p = subprocess.run(args, input = input,
+                       stdin = subprocess.DEVNULL if input is None else None,
+                       stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                       encoding = "utf-8")
+    _G.log_file.write("--- Command: %s\n" % " ".join(args))
+    if p.stdout:
+        _G.log_file.write("--- stdout:\n%s" % p.stdout)
+    if p.stderr:
+        _G.log_file.write("--- stderr:\n%s" % p.stderr)
+    _G.log_file.write("--- Exit status: %s\n" % p.returncode)
+    return p.stdout if p.returncode == 0 else None
+
+# Like _run_process(), but discard the process output, and only return whether
+# it exited with status 0.
+def _run_status(args):
+    status = subprocess.call(args, stdin = subprocess.DEVNULL,
+                             stdout = subprocess.DEVNULL,
+                             stderr = subprocess.DEVNULL)
     _G.log_file.write("--- Command: %s\n" % " ".join(args))
-    if p_out:
-        _G.log_file.write("--- stdout:\n%s" % p_out)
-    if p_err:
-        _G.log_file.write("--- stderr:\n%s" % p_err)
     _G.log_file.write("--- Exit status: %s\n" % status)
-    return p_out if status == 0 else None
+    return status == 0
 
 # Run the C compiler, possibly including linking. Return whether the compiler
 # exited with success status (0 exit code) as boolean. What exactly it does
@@ -534,31 +713,80 @@ def check_cc(include = None, decl = None, expr = None, defined = None,
         if expr:
             contents += expr + "\n"
         contents += "return 0; }\n"
-    source = os.path.join(_G.temp_path, "test." + language)
-    _G.log_file.write("--- Test file %s:\n%s" % (source, contents))
-    with open(source, "w") as f:
-        f.write(contents)
+    _G.log_file.write("--- Test file (stdin):\n%s" % contents)
 
     flags = normalize_list_arg(flags)
     link = normalize_list_arg(link)
 
-    outfile = os.path.join(_G.temp_path, "test")
     # Split CC in case it contains multiple parts (e.g., "ccache gcc")
     cc_parts = get_program("CC").split()
-    args = cc_parts + [source]
+
+    key = None
+    if _G.probe_cache is not None:
+        key = _probe_key(contents, flags, link, use_linking, cc_parts,
+                         _G.cflags, _G.ldflags)
+        cached = _G.probe_cache.get(key, None)
+        if cached is not None:
+            _G.log_file.write("--- Cached result: %s\n" % cached)
+            _G.probe_cache_used[key] = cached
+            if not cached:
+                return False
+            _G.cflags += flags
+            _G.ldflags += link
+            return True
+
+    # The source is piped to the compiler, which avoids writing and reading
+    # back a temporary file for every probe. "-x none" resets the language, so
+    # that object files or libraries in LDFLAGS aren't compiled as C.
+    outfile = _G.test_outfile
+    args = cc_parts + ["-x", language, "-", "-x", "none"]
     args += _G.cflags + flags
     if use_linking:
         args += _G.ldflags + link
-        args += ["-o%s" % outfile]
     else:
-        args += ["-c", "-o%s.o" % outfile]
-    if _run_process(args) is None:
+        outfile += ".o"
+        args += ["-c"]
+    args += ["-o%s" % outfile]
+    # (the .d file is created if CFLAGS contain -MD)
+    _G.temp_files.update((outfile, _G.test_outfile + ".d"))
+    success = _run_process(args, input = contents) is not None
+    if key is not None:
+        _G.probe_cache[key] = success
+        _G.probe_cache_used[key] = success
+    if not success:
         return False
 
     _G.cflags += flags
     _G.ldflags += link
     return True
 
+# Return the value (as string) of a macro predefined by the C compiler, or None
+# if it's not defined. The predefined macros are queried once, without any
+# CFLAGS, so this is much cheaper than repeated check_cc(defined = ...) calls.
+def get_cc_define(name):
+    if _G.cc_predefines is None:
+        _G.cc_predefines = {}
+        res = _run_process(get_program("CC").split() +
+                           ["-E", "-dM", "-x", "c", os.devnull])
+        for line in (res or "").splitlines():
+            parts = line.split(None, 2)
+            if len(parts) >= 2 and parts[0] == "#define":
+                _G.cc_predefines[parts[1]] = parts[2] if len(parts) > 2 else ""
+    return _G.cc_predefines.get(name, None)
+
+# Return the C compiler vendor and version as tuple, e.g. ("gcc", (12, 2, 0)).
+# Returns (None, None) if the compiler is neither GCC nor clang.
+def get_cc_version():
+    if get_cc_define("__clang__") is not None:
+        vendor = "clang"
+        macros = ["__clang_major__", "__clang_minor__", "__clang_patchlevel__"]
+    elif get_cc_define("__GNUC__") is not None:
+        vendor = "gcc"
+        macros = ["__GNUC__", "__GNUC_MINOR__", "__GNUC_PATCHLEVEL__"]
+    else:
+        return (None, None)
+    return (vendor, tuple(int(get_cc_define(m) or 0) for m in macros))
+
 # Run pkg-config with function arguments passed as command arguments. Typically,
 # you specify pkg-config version expressions, like "libass >= 0.14". Returns
 # success as boolean.
@@ -567,17 +795,73 @@ def check_pkg_config(*args):
     args = list(args)
     pkg_config_cmd = [get_program("PKG_CONFIG")]
 
-    cflags = _run_process(pkg_config_cmd + ["--cflags"] + args)
-    if cflags is None:
-        return False
-    ldflags = _run_process(pkg_config_cmd + ["--libs"] + args)
-    if ldflags is None:
+    # Query both with a single invocation; the output is the --cflags output
+    # followed by the --libs output.
+    res = _run_process(pkg_config_cmd + ["--cflags", "--libs", "--print-errors"]
+                       + args)
+    if res is None:
         return False
 
-    _G.cflags += cflags.split()
-    _G.ldflags += ldflags.split()
+    cflags, ldflags = _split_pkg_config_flags(res)
+    # Many packages share include/library paths; don't repeat them, as they'd
+    # be passed to every following compiler invocation.
+    _G.cflags += _dedup_flags(cflags, _G.cflags, ("-I", "-D"))
+    _G.ldflags += _dedup_flags(ldflags, _G.ldflags, ("-L",))
     return True
 
+# Return the flags in new, minus the flags starting with one of the prefixes
+# that are already in existing (or earlier in new). Other flags are kept, since
+# their order and repetition can matter (e.g. -l).
+def _dedup_flags(new, existing, prefixes):
+    seen = set(existing)
+    res = []
+    for fl in new:
+        if fl.startswith(prefixes):
+            if fl in seen:
+                continue
+            seen.add(fl)
+        res.append(fl)
+    return res
+
+# Sort the tokens of a combined "pkg-config --cflags --libs" output into
+# compiler and linker flags. Returns a (cflags, ldflags) tuple of lists. Only
+# flags that clearly belong to one side are sorted; anything else (-pthread,
+# -fopenmp, ...) may matter to both, so it's added to both.
+def _split_pkg_config_flags(output):
+    cflags = []
+    ldflags = []
+    tokens = output.split()
+    i = 0
+    while i < len(tokens):
+        tok = tokens[i]
+        if tok in ("-isystem", "-include") and i + 1 < len(tokens):
+            cflags += tokens[i:i + 2]
+            i += 1
+        elif tok in ("-framework", "-Xlinker") and i + 1 < len(tokens):
+            ldflags += tokens[i:i + 2]
+            i += 1
+        elif tok.startswith(("-I", "-D", "-U", "-isystem")):
+            cflags.append(tok)
+        elif (tok.startswith(("-L", "-l", "-Wl,")) or tok == "-rdynamic" or
+              tok.endswith((".a", ".dylib", ".lib")) or _shlib_re.search(tok)):
+            ldflags.append(tok)
+        else:
+            cflags.append(tok)
+            ldflags.append(tok)
+        i += 1
+    return cflags, ldflags
+
+# Return whether pkg-config finds the packages (like check_pkg_config()), but
+# don't add any flags. The result is cached.
+def check_pkg_config_exists(*args):
+    key = tuple(args)
+    res = _G.pkg_config_exists.get(key, None)
+    if res is None:
+        pkg_config_cmd = [get_program("PKG_CONFIG")]
+        res = _run_status(pkg_config_cmd + ["--exists"] + list(args))
+        _G.pkg_config_exists[key] = res
+    return res
+
 def get_pkg_config_variable(arg, varname):
     typecheck(arg, str)
     pkg_config_cmd = [get_program("PKG_CONFIG")]
@@ -592,7 +876,7 @@ def check_binary_exists(binary_name):
     _G.log_file.write("--- Checking for binary '%s' in PATH...\n" % binary_name)
 
     # Find a binary without executing it.
-    binary_path = shutil.which(binary_name)
+    binary_path = _which(binary_name)
 
     if binary_path:
         _G.log_file.write("--- Found '%s' at '%s'\n" % (binary_name, binary_path))
@@ -601,6 +885,17 @@ def check_binary_exists(binary_name):
         _G.log_file.write("--- Binary '%s' not found in PATH\n" % binary_name)
         return False
 
+# Return whether a working ccache is in PATH. The result is cached.
+def _check_ccache():
+    if _G.have_ccache is None:
+        _G.have_ccache = False
+        if _which("ccache"):
+            try:
+                _G.have_ccache = _run_status(["ccache", "-V"])
+            except OSError:
+                pass
+    return _G.have_ccache
+
 # Check for a specific build tool. You pass in a symbolic name (e.g. "CC"),
 # which is then resolved to a full name and added as variable to config.mak.
 # The function returns a bool for success. You're not supposed to use the
@@ -610,11 +905,11 @@ def check_binary_exists(binary_name):
 def check_program(env_name):
     for name, default in programs_info:
         if name == env_name:
-            val = os.environ.get(env_name, None)
+            val = _environ.get(env_name, None)
             if val is None:
-                prefix = os.environ.get("TARGET", None)
+                prefix = _environ.get("TARGET", None)
                 if prefix is None:
-                    prefix = os.environ.get("CROSS_COMPILE", "")
+                    prefix = _environ.get("CROSS_COMPILE", "")
                 # Dumb hack: default to gcc if a prefix is given, as binutils
                 # toolchains generally provide only a -gcc wrapper.
                 if prefix and default == "cc":
@@ -625,19 +920,17 @@ def check_program(env_name):
             # Check if ccache should be auto-enabled (unless explicitly disabled or already present)
             if env_name == "CC":
                 # Check if user explicitly disabled ccache via CCACHE=no/0/false
-                ccache_disabled = os.environ.get("CCACHE", "").lower() in {"no", "0", "false"}
+                ccache_disabled = _environ.get("CCACHE", "").lower() in {"no", "0", "false"}
                 # Check if CC already contains ccache to avoid double-wrapping
                 val_parts = val.split()
                 already_has_ccache = val_parts and os.path.basename(val_parts[0]) == "ccache"
 
                 if not ccache_disabled and not already_has_ccache:
-                    # Check if ccache is available
-                    try:
-                        if _run_process(["ccache", "-V"]) is not None:
-                            # ccache is available, wrap the compiler with it
-                            val = "ccache " + val
-                            _G.log_file.write("--- ccache detected, enabling automatic caching\n")
-                    except OSError:
+                    if _check_ccache():
+                        # ccache is available, wrap the compiler with it
+                        val = "ccache " + val
+                        _G.log_file.write("--- ccache detected, enabling automatic caching\n")
+                    else:
                         # ccache not available, continue without it
                         _G.log_file.write("--- ccache not found, proceeding without caching\n")
                 elif ccache_disabled:
@@ -656,7 +949,7 @@ def check_program(env_name):
                         os.path.basename(val_parts[0]) == "ccache")
             test_cmd = val_parts if is_ccache else [val]
             try:
-                _run_process(test_cmd)
+                _run_status(test_cmd)
             except OSError as err:
                 _G.log_file.write("%s\n" % err)
                 return False
@@ -692,16 +985,22 @@ def add_ldflags(*fl):
 # If val is a string, it's quoted as string literal.
 # If val is None, it's defined without value.
 def add_config_h_define(name, val):
+    if type(val) == int:
+        # Fast path for the HAVE_* 0/1 defines emitted by check(). Also see
+        # below; plain numbers need no quoting or unquoting.
+        _G.config_h.write("#define %s %d\n" % (name, val))
+        if name.startswith("HAVE_") and _ident_re.match(name):
+            _G.config_mak.write("%s = %d\n" % (name, val))
+        return
     if type(val) == type("") or type(val) == type(b""):
         val = _c_quote_string(val)
     if val is None:
         val = ""
-    _G.config_h += "#define %s %s\n" % (name, val)
+    _G.config_h.write("#define %s %s\n" % (name, val))
     # Also export HAVE_* defines to config.mak so Makefile can read them reliably.
     # Only export simple identifiers (avoid exporting arbitrary strings).
     try:
-        import re
-        if re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', name) and name.startswith("HAVE_"):
+        if _ident_re.match(name) and name.startswith("HAVE_"):
             # val may be a quoted string; normalize to unquoted token or 0/1.
             v = val
             # If it's a quoted string, keep as-is; else if it's numeric or empty, pass through.
@@ -719,22 +1018,130 @@ def add_config_h_define(name, val):
 def add_config_mak_var(name, val):
     if type(val) == type("") or type(val) == type(b""):
         val = _c_quote_makefile_var(val)
-    _G.config_mak += "%s = %s\n" % (name, val)
+    _G.config_mak.write("%s = %s\n" % (name, val))
 
 # Add these source files to the build.
 def add_sources(*sources):
-    _G.sources += list(sources)
+    for s in sources:
+        _G.sources[s] = None
 
 # Get an environment variable and parse it as flags array.
 def _get_env_flags(name):
-    res = os.environ.get(name, "").split()
+    res = _environ.get(name, "").split()
     if len(res) == 1 and len(res[0]) == 0:
         res = []
     return res
 
-# Generate build.ninja file for Ninja backend
+# Write contents to the file at path, unless the file already has exactly these
+# contents. This keeps the mtime on re-configure, so nothing depending on the
+# file gets rebuilt. The file is replaced atomically.
+def _write_file_if_changed(path, contents):
+    try:
+        with open(path, "r") as f:
+            if f.read() == contents:
+                return
+    except (OSError, ValueError):
+        pass
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+# Object file build statements, with and without implicit deps.
+_build_cc_tmpl = "build %s: cc %s"
+_build_cc_deps_tmpl = "build %s: cc %s | %s"
+
+# Generated files each source depends on, keyed by the source path relative to
+# $(ROOT). Looked up once per source in _generate_ninja_file().
+_no_deps = ()
+_version_h_deps = ["$builddir/generated/version.h"]
+_ebml_deps = [
+    "$builddir/generated/ebml_types.h",
+    "$builddir/generated/ebml_defs.c",
+]
+_implicit_deps = {
+    "common/version.c": _version_h_deps,
+    "osdep/dmpv.c": _version_h_deps,
+    "demux/demux_mkv.c": _ebml_deps,
+    "demux/ebml.c": _ebml_deps,
+    "input/input.c": [
+        "$builddir/generated/etc/input.conf.inc",
+        "$builddir/generated/etc/input_vo_gpu_next.conf.inc",
+        "$builddir/generated/etc/input_vo_gpu.conf.inc",
+        "$builddir/generated/etc/input_vo_dmabuf_wayland.conf.inc",
+        "$builddir/generated/etc/input_vo_wlshm.conf.inc",
+        "$builddir/generated/etc/input_vo_vdpau.conf.inc",
+        "$builddir/generated/etc/input_vo_x11.conf.inc",
+        "$builddir/generated/etc/input_vo_drm.conf.inc",
+    ],
+    "player/main.c": ["$builddir/generated/etc/builtin.conf.inc"],
+    "sub/osd_libass.c": ["$builddir/generated/sub/osd_font.otf.inc"],
+    "player/lua.c": [
+        "$builddir/generated/player/lua/defaults.lua.inc",
+        "$builddir/generated/player/lua/assdraw.lua.inc",
+        "$builddir/generated/player/lua/options.lua.inc",
+        "$builddir/generated/player/lua/stats.lua.inc",
+        "$builddir/generated/player/lua/360-sbs.lua.inc",
+        "$builddir/generated/player/lua/360-sg.lua.inc",
+        "$builddir/generated/player/lua/positioning.lua.inc",
+        "$builddir/generated/player/lua/ytdl_hook.lua.inc",
+    ],
+    "video/out/x11_common.c": [
+        "$builddir/generated/etc/dmpv-icon-8bit-16x16.png.inc",
+        "$builddir/generated/etc/dmpv-icon-8bit-32x32.png.inc",
+        "$builddir/generated/etc/dmpv-icon-8bit-64x64.png.inc",
+        "$builddir/generated/etc/dmpv-icon-8bit-128x128.png.inc",
+    ],
+}
+
+# Install and uninstall rules for build.ninja. These are str.format()
+# templates taking the install prefix and the executable suffix.
+_icon_sizes = (16, 32, 64, 128)
+_install_rule_tmpl = (
+    "rule install_rule\n"
+    "  command = " + " && ".join(
+        ["mkdir -p " + " ".join(
+            ["{prefix}/bin"] +
+            ["{prefix}/share/icons/hicolor/%dx%d/apps" % (n, n)
+             for n in _icon_sizes] +
+            ["{prefix}/share/icons/hicolor/scalable/apps",
+             "{prefix}/share/icons/hicolor/symbolic/apps",
+             "{prefix}/share/applications",
+             "{prefix}/etc"]),
+         "install -v -m 0755 $builddir/dmpv{exesuf} {prefix}/bin/dmpv{exesuf}",
+         "install -v -m 0755 ../TOOLS/udmpv {prefix}/bin"] +
+        ["install -v -m 0644 $root/etc/dmpv-icon-8bit-%dx%d.png "
+         "{prefix}/share/icons/hicolor/%dx%d/apps/dmpv.png" % (n, n, n, n)
+         for n in _icon_sizes] +
+        ["install -v -m 0644 $root/etc/dmpv.svg "
+         "{prefix}/share/icons/hicolor/scalable/apps/dmpv.svg",
+         "install -v -m 0644 $root/etc/dmpv-symbolic.svg "
+         "{prefix}/share/icons/hicolor/symbolic/apps/dmpv-symbolic.svg",
+         "install -v -m 0644 $root/etc/dmpv.desktop "
+         "{prefix}/share/applications/dmpv.desktop",
+         "install -v -m 0644 $root/etc/dmpv.conf {prefix}/etc/dmpv.conf"]) +
+    "\n"
+    "  description = INSTALL\n"
+    "\n")
+_uninstall_rule_tmpl = (
+    "rule uninstall_rule\n"
+    "  command = rm -fv " + " ".join(
+        ["{prefix}/bin/dmpv{exesuf}",
+         "{prefix}/bin/udmpv"] +
+        ["{prefix}/share/icons/hicolor/%dx%d/apps/dmpv.png" % (n, n)
+         for n in _icon_sizes] +
+        ["{prefix}/share/icons/hicolor/scalable/apps/dmpv.svg",
+         "{prefix}/share/icons/hicolor/symbolic/apps/dmpv-symbolic.svg",
+         "{prefix}/share/applications/dmpv.desktop",
+         "{prefix}/etc/dmpv.conf"]) +
+    "\n"
+    "  description = UNINSTALL\n"
+    "\n")
+
+# Generate build.ninja file for Ninja backend. Returns the file contents as a
+# list of string chunks.
 def _generate_ninja_file(sources, cflags_str, ldflags_str):
-    ninja_content = "# Generated by configure.\n\n"
+    parts = ["# Generated by configure.\n\n"]
 
     # Get programs
     cc = _G.programs.get("CC", "cc")
@@ -746,10 +1153,10 @@ def _generate_ninja_file(sources, cflags_str, ldflags_str):
 
     # Get wayland proto dir if available
     wl_proto_dir = ""
-    import re
-    wl_match = re.search(r'^WL_PROTO_DIR\s*=\s*(.+)$', _G.config_mak, re.MULTILINE)
+    wl_match = _wl_proto_dir_re.search(_G.config_mak.getvalue())
     if wl_match:
         wl_proto_dir = wl_match.group(1).strip()
+    has_wayland = bool(wl_proto_dir) and any("wayland" in s for s in sources)
 
     # Pre-create all necessary directories to avoid per-file mkdir overhead
     dirs_to_create = set()
@@ -763,119 +1170,130 @@ def _generate_ninja_file(sources, cflags_str, ldflags_str):
 
     # Create directories for object files based on sources
     for src in sources:
-        src_path = src.replace("$(BUILD)/", "").replace("$(ROOT)/", "")
+        if src.startswith("$(BUILD)/"):
+            src_path = src[9:]
+        elif src.startswith("$(ROOT)/"):
+            src_path = src[8:]
+        else:
+            src_path = src
         if src_path.endswith(".c") or src_path.endswith(".rc"):
             obj_dir = os.path.dirname(os.path.join(build_dir, src_path))
             dirs_to_create.add(obj_dir)
 
-    # Create all directories upfront
-    for d in dirs_to_create:
-        os.makedirs(d, exist_ok=True)
+    # Create all directories upfront. Parents are created implicitly by
+    # makedirs(), so only the leaves are passed to it. The calls are mostly
+    # syscall latency, so run them from a thread pool.
+    leaf_dirs = dirs_to_create - {os.path.dirname(d) for d in dirs_to_create}
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers = min(32, len(leaf_dirs))) as pool:
+        for _ in pool.map(lambda d: os.makedirs(d, exist_ok=True), leaf_dirs):
+            pass
 
     # Define variables
-    ninja_content += f"builddir = {build_dir}\n"
-    ninja_content += f"root = {root_dir}\n"
-    ninja_content += f"cc = {cc}\n"
-    ninja_content += f"wayscan = {wayscan}\n"
-    ninja_content += f"cflags = {cflags_str}\n"
-    ninja_content += f"ldflags = {ldflags_str}\n"
+    parts.append(f"builddir = {build_dir}\n")
+    parts.append(f"root = {root_dir}\n")
+    parts.append(f"cc = {cc}\n")
+    parts.append(f"wayscan = {wayscan}\n")
+    parts.append(f"cflags = {cflags_str}\n")
+    parts.append(f"ldflags = {ldflags_str}\n")
     exesuf = ".exe" if _G.exe_format == "pe" else ""
-    ninja_content += f"exesuf = {exesuf}\n"
+    parts.append(f"exesuf = {exesuf}\n")
     if wl_proto_dir:
-        ninja_content += f"wl_proto_dir = {wl_proto_dir}\n"
-    ninja_content += "\n"
+        parts.append(f"wl_proto_dir = {wl_proto_dir}\n")
+    parts.append("\n")
 
     # Define rules
-    ninja_content += "rule cc\n"
-    ninja_content += "  command = $cc $cflags -I$root -I$builddir $in -c -o $out -MF $out.d\n"
-    ninja_content += "  description = CC $out\n"
-    ninja_content += "  depfile = $out.d\n"
-    ninja_content += "  deps = gcc\n"
-    ninja_content += "\n"
-
-    ninja_content += "rule link\n"
-    ninja_content += "  command = $cc @$out.rsp $ldflags -o $out\n"
-    ninja_content += "  description = LINK $out\n"
-    ninja_content += "  rspfile = $out.rsp\n"
-    ninja_content += "  rspfile_content = $in\n"
-    ninja_content += "\n"
-
-    ninja_content += "rule version\n"
-    ninja_content += "  command = cd $root && ./version.sh --versionh=build/generated/version.h\n"
-    ninja_content += "  description = VERSION $out\n"
-    ninja_content += "\n"
-
-    ninja_content += "rule ebml_header\n"
-    ninja_content += "  command = $root/TOOLS/matroska.py --generate-header $out\n"
-    ninja_content += "  description = EBML $out\n"
-    ninja_content += "\n"
-
-    ninja_content += "rule ebml_defs\n"
-    ninja_content += "  command = $root/TOOLS/matroska.py --generate-definitions $out\n"
-    ninja_content += "  description = EBML $out\n"
-    ninja_content += "\n"
-
-    ninja_content += "rule file2string\n"
-    ninja_content += "  command = $root/TOOLS/file2string.py $in $out $root\n"
-    ninja_content += "  description = INC $out\n"
-    ninja_content += "\n"
+    parts.append("rule cc\n")
+    parts.append("  command = $cc $cflags -I$root -I$builddir $in -c -o $out -MF $out.d\n")
+    parts.append("  description = CC $out\n")
+    parts.append("  depfile = $out.d\n")
+    parts.append("  deps = gcc\n")
+    parts.append("\n")
+
+    parts.append("rule link\n")
+    parts.append("  command = $cc @$out.rsp $ldflags -o $out\n")
+    parts.append("  description = LINK $out\n")
+    parts.append("  rspfile = $out.rsp\n")
+    parts.append("  rspfile_content = $in\n")
+    parts.append("\n")
+
+    parts.append("rule version\n")
+    parts.append("  command = cd $root && ./version.sh --versionh=build/generated/version.h\n")
+    parts.append("  description = VERSION $out\n")
+    parts.append("\n")
+
+    parts.append("rule ebml_header\n")
+    parts.append("  command = $root/TOOLS/matroska.py --generate-header $out\n")
+    parts.append("  description = EBML $out\n")
+    parts.append("\n")
+
+    parts.append("rule ebml_defs\n")
+    parts.append("  command = $root/TOOLS/matroska.py --generate-definitions $out\n")
+    parts.append("  description = EBML $out\n")
+    parts.append("\n")
+
+    parts.append("rule file2string\n")
+    parts.append("  command = $root/TOOLS/file2string.py $in $out $root\n")
+    parts.append("  description = INC $out\n")
+    parts.append("\n")
 
     if wl_proto_dir:
-        ninja_content += "rule wayland_code\n"
-        ninja_content += "  command = $wayscan private-code $in $out\n"
-        ninja_content += "  description = WAYSHC $out\n"
-        ninja_content += "\n"
+        parts.append("rule wayland_code\n")
+        parts.append("  command = $wayscan private-code $in $out\n")
+        parts.append("  description = WAYSHC $out\n")
+        parts.append("\n")
 
-        ninja_content += "rule wayland_header\n"
-        ninja_content += "  command = $wayscan client-header $in $out\n"
-        ninja_content += "  description = WAYSHH $out\n"
-        ninja_content += "\n"
+        parts.append("rule wayland_header\n")
+        parts.append("  command = $wayscan client-header $in $out\n")
+        parts.append("  description = WAYSHH $out\n")
+        parts.append("\n")
 
     # Generate build statements for generated files
-    ninja_content += "# Generated files\n"
+    parts.append("# Generated files\n")
     # Create an always-rebuild phony target to force version check on every build
-    ninja_content += "build _version_check: phony\n"
-    ninja_content += "\n"
+    parts.append("build _version_check: phony\n")
+    parts.append("\n")
     # Mark version.h as a generator that depends on the always-rebuild target
-    ninja_content += f"build $builddir/generated/version.h: version _version_check\n"
-    ninja_content += f"  generator = 1\n"
-    ninja_content += "\n"
+    parts.append(f"build $builddir/generated/version.h: version _version_check\n")
+    parts.append(f"  generator = 1\n")
+    parts.append("\n")
 
-    ninja_content += f"build $builddir/generated/ebml_types.h: ebml_header\n"
-    ninja_content += f"build $builddir/generated/ebml_defs.c: ebml_defs\n"
-    ninja_content += "\n"
+    parts.append(f"build $builddir/generated/ebml_types.h: ebml_header\n")
+    parts.append(f"build $builddir/generated/ebml_defs.c: ebml_defs\n")
+    parts.append("\n")
 
     # Generate .inc files for config files
-    inc_files = [
-        ("etc/input.conf", "$builddir/generated/etc/input.conf.inc"),
-        ("etc/input_vo_gpu_next.conf", "$builddir/generated/etc/input_vo_gpu_next.conf.inc"),
-        ("etc/input_vo_gpu.conf", "$builddir/generated/etc/input_vo_gpu.conf.inc"),
-        ("etc/input_vo_dmabuf_wayland.conf", "$builddir/generated/etc/input_vo_dmabuf_wayland.conf.inc"),
-        ("etc/input_vo_wlshm.conf", "$builddir/generated/etc/input_vo_wlshm.conf.inc"),
-        ("etc/input_vo_vdpau.conf", "$builddir/generated/etc/input_vo_vdpau.conf.inc"),
-        ("etc/input_vo_x11.conf", "$builddir/generated/etc/input_vo_x11.conf.inc"),
-        ("etc/input_vo_drm.conf", "$builddir/generated/etc/input_vo_drm.conf.inc"),
-        ("etc/builtin.conf", "$builddir/generated/etc/builtin.conf.inc"),
-        ("etc/dmpv-icon-8bit-16x16.png", "$builddir/generated/etc/dmpv-icon-8bit-16x16.png.inc"),
-        ("etc/dmpv-icon-8bit-32x32.png", "$builddir/generated/etc/dmpv-icon-8bit-32x32.png.inc"),
-        ("etc/dmpv-icon-8bit-64x64.png", "$builddir/generated/etc/dmpv-icon-8bit-64x64.png.inc"),
-        ("etc/dmpv-icon-8bit-128x128.png", "$builddir/generated/etc/dmpv-icon-8bit-128x128.png.inc"),
-        ("sub/osd_font.otf", "$builddir/generated/sub/osd_font.otf.inc"),
-        ("player/lua/defaults.lua", "$builddir/generated/player/lua/defaults.lua.inc"),
-        ("player/lua/assdraw.lua", "$builddir/generated/player/lua/assdraw.lua.inc"),
-        ("player/lua/options.lua", "$builddir/generated/player/lua/options.lua.inc"),
-        ("player/lua/stats.lua", "$builddir/generated/player/lua/stats.lua.inc"),
-        ("player/lua/360-sbs.lua", "$builddir/generated/player/lua/360-sbs.lua.inc"),
-        ("player/lua/360-sg.lua", "$builddir/generated/player/lua/360-sg.lua.inc"),
-        ("player/lua/positioning.lua", "$builddir/generated/player/lua/positioning.lua.inc"),
-        ("player/lua/ytdl_hook.lua", "$builddir/generated/player/lua/ytdl_hook.lua.inc"),
+    inc_srcs = [
+        "etc/input.conf",
+        "etc/input_vo_gpu_next.conf",
+        "etc/input_vo_gpu.conf",
+        "etc/input_vo_dmabuf_wayland.conf",
+        "etc/input_vo_wlshm.conf",
+        "etc/input_vo_vdpau.conf",
+        "etc/input_vo_x11.conf",
+        "etc/input_vo_drm.conf",
+        "etc/builtin.conf",
+        "etc/dmpv-icon-8bit-16x16.png",
+        "etc/dmpv-icon-8bit-32x32.png",
+        "etc/dmpv-icon-8bit-64x64.png",
+        "etc/dmpv-icon-8bit-128x128.png",
+        "sub/osd_font.otf",
+        "player/lua/defaults.lua",
+        "player/lua/assdraw.lua",
+        "player/lua/options.lua",
+        "player/lua/stats.lua",
+        "player/lua/360-sbs.lua",
+        "player/lua/360-sg.lua",
+        "player/lua/positioning.lua",
+        "player/lua/ytdl_hook.lua",
     ]
-    for src, dst in inc_files:
-        ninja_content += f"build {dst}: file2string $root/{src}\n"
-    ninja_content += "\n"
+    parts.append("\n".join(f"build $builddir/generated/{src}.inc: file2string $root/{src}"
+                           for src in inc_srcs))
+    parts.append("\n\n")
 
     # Generate wayland protocol files if wayland is enabled
-    if wl_proto_dir and "wayland" in str(sources):
+    wayland_header_deps = ()
+    if has_wayland:
         wayland_protocols = [
             ("unstable/idle-inhibit", "idle-inhibit-unstable-v1"),
             ("stable/presentation-time", "presentation-time"),
@@ -891,122 +1309,102 @@ def _generate_ninja_file(sources, cflags_str, ldflags_str):
             ("staging/color-management", "color-management-v1"),
             ("staging/single-pixel-buffer", "single-pixel-buffer-v1"),
         ]
+        wl_lines = []
         for proto_dir, proto_name in wayland_protocols:
-            ninja_content += f"build $builddir/generated/wayland/{proto_name}.c: wayland_code $wl_proto_dir/{proto_dir}/{proto_name}.xml\n"
-            ninja_content += f"build $builddir/generated/wayland/{proto_name}.h: wayland_header $wl_proto_dir/{proto_dir}/{proto_name}.xml\n"
-        ninja_content += "\n"
+            wl_lines.append(f"build $builddir/generated/wayland/{proto_name}.c: wayland_code $wl_proto_dir/{proto_dir}/{proto_name}.xml")
+            wl_lines.append(f"build $builddir/generated/wayland/{proto_name}.h: wayland_header $wl_proto_dir/{proto_dir}/{proto_name}.xml")
+        parts.append("\n".join(wl_lines))
+        parts.append("\n\n")
+        # Every wayland source depends on all protocol headers
+        wayland_header_deps = tuple(f"$builddir/generated/wayland/{proto_name}.h"
+                                    for _, proto_name in wayland_protocols)
 
     # Process sources and generate build statements
-    ninja_content += "# Object files\n"
+    parts.append("# Object files\n")
     objects = []
+    edges = []
     for src in sources:
-        # Replace Make variables with Ninja variables
-        src_path = src.replace("$(BUILD)", "$builddir").replace("$(ROOT)", "$root")
+        # Replace Make variables with Ninja variables. Sources are prefixed
+        # with exactly one of them (see finish()).
+        if src.startswith("$(BUILD)/"):
+            rel_src = src[9:]
+            src_path = "$builddir/" + rel_src
+            obj_dir = "$builddir/"
+        elif src.startswith("$(ROOT)/"):
+            rel_src = src[8:]
+            src_path = "$root/" + rel_src
+            obj_dir = "$builddir/"
+        else:
+            rel_src = src_path = src
+            obj_dir = ""
 
         # Determine output object file path
         if src.endswith(".c"):
-            obj = src.replace(".c", ".o")
+            obj = rel_src[:-2] + ".o"
         elif src.endswith(".rc"):
-            obj = src.replace(".rc", ".o")
+            obj = rel_src[:-3] + ".o"
         else:
             continue
 
         # All object files go to build directory
         # For $(BUILD)/foo.o -> $builddir/foo.o
         # For $(ROOT)/bar.o -> $builddir/bar.o
-        obj_path = obj.replace("$(BUILD)/", "$builddir/").replace("$(ROOT)/", "$builddir/")
+        obj_path = obj_dir + obj
         objects.append(obj_path)
 
-        # Determine dependencies for generated files
-        implicit_deps = []
-        if "common/version.c" in src or "osdep/dmpv.c" in src:
-            implicit_deps.append("$builddir/generated/version.h")
-        if "demux/demux_mkv.c" in src or "demux/ebml.c" in src:
-            implicit_deps.append("$builddir/generated/ebml_types.h")
-            implicit_deps.append("$builddir/generated/ebml_defs.c")
-        if "input/input.c" in src:
-            implicit_deps.append("$builddir/generated/etc/input.conf.inc")
-            implicit_deps.append("$builddir/generated/etc/input_vo_gpu_next.conf.inc")
-            implicit_deps.append("$builddir/generated/etc/input_vo_gpu.conf.inc")
-            implicit_deps.append("$builddir/generated/etc/input_vo_dmabuf_wayland.conf.inc")
-            implicit_deps.append("$builddir/generated/etc/input_vo_wlshm.conf.inc")
-            implicit_deps.append("$builddir/generated/etc/input_vo_vdpau.conf.inc")
-            implicit_deps.append("$builddir/generated/etc/input_vo_x11.conf.inc")
-            implicit_deps.append("$builddir/generated/etc/input_vo_drm.conf.inc")
-        if "player/main.c" in src:
-            implicit_deps.append("$builddir/generated/etc/builtin.conf.inc")
-        if "sub/osd_libass.c" in src:
-            implicit_deps.append("$builddir/generated/sub/osd_font.otf.inc")
-        if "player/lua.c" in src:
-            implicit_deps.extend([
-                "$builddir/generated/player/lua/defaults.lua.inc",
-                "$builddir/generated/player/lua/assdraw.lua.inc",
-                "$builddir/generated/player/lua/options.lua.inc",
-                "$builddir/generated/player/lua/stats.lua.inc",
-                "$builddir/generated/player/lua/360-sbs.lua.inc",
-                "$builddir/generated/player/lua/360-sg.lua.inc",
-                "$builddir/generated/player/lua/positioning.lua.inc",
-                "$builddir/generated/player/lua/ytdl_hook.lua.inc",
-            ])
-        if "video/out/x11_common.c" in src:
-            implicit_deps.extend([
-                "$builddir/generated/etc/dmpv-icon-8bit-16x16.png.inc",
-                "$builddir/generated/etc/dmpv-icon-8bit-32x32.png.inc",
-                "$builddir/generated/etc/dmpv-icon-8bit-64x64.png.inc",
-                "$builddir/generated/etc/dmpv-icon-8bit-128x128.png.inc",
-            ])
-        if "wayland" in src and wl_proto_dir:
-            # Add wayland protocol dependencies
-            for proto_dir, proto_name in wayland_protocols:
-                implicit_deps.append(f"$builddir/generated/wayland/{proto_name}.h")
-
-        # Generate build statement
+        # Determine dependencies for generated files. This is a tuple of dep
+        # lists, so that the shared lists are referenced instead of copied.
+        implicit_deps = _no_deps
+        table_deps = _implicit_deps.get(rel_src)
+        if table_deps:
+            implicit_deps = (table_deps,)
+        if has_wayland and "wayland" in src:
+            implicit_deps += (wayland_header_deps,)
+
         if src.endswith(".c"):
-            if implicit_deps:
-                ninja_content += f"build {obj_path}: cc {src_path} | {' '.join(implicit_deps)}\n"
-            else:
-                ninja_content += f"build {obj_path}: cc {src_path}\n"
+            edges.append((obj_path, src_path, implicit_deps))
 
-    ninja_content += "\n"
+    # Generate build statements
+    if edges:
+        parts.append("\n".join(
+            _build_cc_deps_tmpl % (o, s, " ".join(itertools.chain.from_iterable(d)))
+            if d else _build_cc_tmpl % (o, s)
+            for o, s, d in edges))
+        parts.append("\n")
+    parts.append("\n")
 
     # Link target
     target = f"$builddir/dmpv$exesuf"
     # Add version.h as order-only dependency to ensure link runs when version changes
     # Use | to specify order-only dependency so it's not included in $in (and thus not in the response file)
-    ninja_content += f"build {target}: link {' '.join(objects)} | $builddir/generated/version.h\n"
-    ninja_content += "\n"
+    parts.append(f"build {target}: link ")
+    parts.append(" ".join(objects))
+    parts.append(" | $builddir/generated/version.h\n\n")
 
     # Default target
-    ninja_content += f"default {target}\n"
-    ninja_content += "\n"
+    parts.append(f"default {target}\n")
+    parts.append("\n")
 
     # Install/uninstall/clean rules
     prefix = _G.install_paths.get("PREFIX", "/usr/local")
 
-    ninja_content += "rule install_rule\n"
-    ninja_content += f"  command = mkdir -p {prefix}/bin {prefix}/share/icons/hicolor/16x16/apps {prefix}/share/icons/hicolor/32x32/apps {prefix}/share/icons/hicolor/64x64/apps {prefix}/share/icons/hicolor/128x128/apps {prefix}/share/icons/hicolor/scalable/apps {prefix}/share/icons/hicolor/symbolic/apps {prefix}/share/applications {prefix}/etc && install -v -m 0755 $builddir/dmpv{exesuf} {prefix}/bin/dmpv{exesuf} && install -v -m 0755 ../TOOLS/udmpv {prefix}/bin && install -v -m 0644 $root/etc/dmpv-icon-8bit-16x16.png {prefix}/share/icons/hicolor/16x16/apps/dmpv.png && install -v -m 0644 $root/etc/dmpv-icon-8bit-32x32.png {prefix}/share/icons/hicolor/32x32/apps/dmpv.png && install -v -m 0644 $root/etc/dmpv-icon-8bit-64x64.png {prefix}/share/icons/hicolor/64x64/apps/dmpv.png && install -v -m 0644 $root/etc/dmpv-icon-8bit-128x128.png {prefix}/share/icons/hicolor/128x128/apps/dmpv.png && install -v -m 0644 $root/etc/dmpv.svg {prefix}/share/icons/hicolor/scalable/apps/dmpv.svg && install -v -m 0644 $root/etc/dmpv-symbolic.svg {prefix}/share/icons/hicolor/symbolic/apps/dmpv-symbolic.svg && install -v -m 0644 $root/etc/dmpv.desktop {prefix}/share/applications/dmpv.desktop && install -v -m 0644 $root/etc/dmpv.conf {prefix}/etc/dmpv.conf\n"
-    ninja_content += "  description = INSTALL\n"
-    ninja_content += "\n"
+    parts.append(_install_rule_tmpl.format(prefix = prefix, exesuf = exesuf))
+    parts.append(_uninstall_rule_tmpl.format(prefix = prefix, exesuf = exesuf))
 
-    ninja_content += "rule uninstall_rule\n"
-    ninja_content += f"  command = rm -fv {prefix}/bin/dmpv{exesuf} {prefix}/bin/udmpv {prefix}/share/icons/hicolor/16x16/apps/dmpv.png {prefix}/share/icons/hicolor/32x32/apps/dmpv.png {prefix}/share/icons/hicolor/64x64/apps/dmpv.png {prefix}/share/icons/hicolor/128x128/apps/dmpv.png {prefix}/share/icons/hicolor/scalable/apps/dmpv.svg {prefix}/share/icons/hicolor/symbolic/apps/dmpv-symbolic.svg {prefix}/share/applications/dmpv.desktop {prefix}/etc/dmpv.conf\n"
-    ninja_content += "  description = UNINSTALL\n"
-    ninja_content += "\n"
-
-    ninja_content += "rule clean\n"
-    ninja_content += f"  command = ninja -C $builddir -t clean\n"
-    ninja_content += "  description = CLEAN\n"
-    ninja_content += "\n"
+    parts.append("rule clean\n")
+    parts.append(f"  command = ninja -C $builddir -t clean\n")
+    parts.append("  description = CLEAN\n")
+    parts.append("\n")
 
     # Phony targets
     # Note: install target does not depend on the build target to avoid
     # rebuilding files as root when running 'sudo make install'
-    ninja_content += "build install: install_rule\n"
-    ninja_content += "build uninstall: uninstall_rule\n"
-    ninja_content += "build clean: clean\n"
-    ninja_content += "\n"
+    parts.append("build install: install_rule\n")
+    parts.append("build uninstall: uninstall_rule\n")
+    parts.append("build clean: clean\n")
+    parts.append("\n")
 
-    return ninja_content
+    return parts
 
 # To be called at the end of user checks.
 def finish():
@@ -1021,12 +1419,14 @@ def finish():
     if is_fatal:
         die("Unknown feature was force-enabled.")
 
-    _G.config_h += "\n"
+    if __debug__:
+        _validate_dep_ids(_G.unchecked_deps)
+
+    _G.config_h.write("\n")
     add_config_h_define("CONFIGURATION", " ".join(sys.argv))
     def _resolve_install_path(val, max_iter=10):
         if val is None:
             return None
-        import re
         res = val
         for _ in range(max_iter):
             changed_flag = [False]
@@ -1036,7 +1436,7 @@ def finish():
                     changed_flag[0] = True
                     return _G.install_paths[name]
                 return match.group(0)
-            new = re.sub(r"\$\(([^)]+)\)", repl, res)
+            new = _make_var_re.sub(repl, res)
             if not changed_flag[0]:
                 res = new
                 break
@@ -1054,29 +1454,28 @@ def finish():
     # Emit per-feature #defines in config.h using canonical HAVE_... names.
     # This avoids creating short lowercase macros (like 'alsa') that collide
     # with identifiers in the code. Produce names like HAVE_ALSA, HAVE_OSS, etc.
-    import re
     def token_to_define(tok):
         # If token already looks like a C identifier and already starts with HAVE_,
         # return it unchanged.
-        if re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', tok) and tok.startswith("HAVE_"):
+        if _ident_re.match(tok) and tok.startswith("HAVE_"):
             return tok
         # Otherwise synthesize HAVE_<UPPERCASE_TOKEN>, replacing illegal chars.
-        s = re.sub(r'[^A-Za-z0-9]', '_', tok)   # replace non-alnum with underscore
+        s = _nonalnum_re.sub('_', tok)   # replace non-alnum with underscore
         s = s.upper()
         if not s.startswith("HAVE_"):
             s = "HAVE_" + s
         # Ensure it is a valid identifier (fallback)
-        if not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', s):
+        if not _ident_re.match(s):
             # sanitize again more aggressively
-            s = re.sub(r'^[^A-Za-z_]+', '', s)
+            s = _leading_bad_re.sub('', s)
             if not s:
                 s = "HAVE_FEATURE"
         return s
 
-    _G.config_h += "\n"
-    for tok in sorted(enabled_features):
-        name = token_to_define(tok)
-        _G.config_h += "#define %s 1\n" % name
+    _G.config_h.write("\n")
+    names = [token_to_define(tok) for tok in sorted(enabled_features)]
+    _G.config_h.write("".join("#define %s 1\n" % name for name in names))
+    for name in names:
         # Also export synthesized HAVE_* names into config.mak so make can
         # evaluate them at parse time (useful for conditional generation).
         try:
@@ -1084,28 +1483,29 @@ def finish():
         except Exception:
             # best-effort: do not fail configure if exporting fails
             pass
-    with open(os.path.join(_G.build_dir, "config.h"), "w") as f:
-        f.write(_G.config_h)
+    _write_file_if_changed(os.path.join(_G.build_dir, "config.h"),
+                           _G.config_h.getvalue())
 
     add_config_mak_var("BUILD", _G.build_dir)
     add_config_mak_var("ROOT", _G.root_dir)
-    _G.config_mak += "\n"
+    _G.config_mak.write("\n")
 
     add_config_mak_var("EXESUF", ".exe" if _G.exe_format == "pe" else "")
 
     for name, _ in install_paths_info:
         add_config_mak_var(name, _G.install_paths[name])
-    _G.config_mak += "\n"
-
-    _G.config_mak += "CFLAGS = %s %s %s\n" % (" ".join(_G.cflags),
-                                              os.environ.get("CPPFLAGS", ""),
-                                              os.environ.get("CFLAGS", ""))
-    _G.config_mak += "\n"
-    _G.config_mak += "LDFLAGS = %s %s\n" % (" ".join(_G.ldflags),
-                                            os.environ.get("LDFLAGS", ""))
-    _G.config_mak += "\n"
-
-    sources = []
+    _G.config_mak.write("\n")
+
+    _G.config_mak.write("CFLAGS = %s %s %s\n" % (" ".join(_G.cflags),
+                                                  _environ.get("CPPFLAGS", ""),
+                                                  _environ.get("CFLAGS", "")))
+    _G.config_mak.write("\n")
+    _G.config_mak.write("LDFLAGS = %s %s\n" % (" ".join(_G.ldflags),
+                                                _environ.get("LDFLAGS", "")))
+    _G.config_mak.write("\n")
+
+    # (a dict, so that sources added both with and without prefix collapse)
+    sources = {}
     for s in _G.sources:
         # Prefix all source files with "$(ROOT)/". This is important for out of
         # tree builds, where configure/make is run from "somewhere else", and
@@ -1124,26 +1524,28 @@ def finish():
                 s = "$(BUILD)/%s" % s
             else:
                 s = "$(ROOT)/%s" % s
-        sources.append(s)
+        sources[s] = None
 
-    # Deduplicate sources (in case multiple features add the same source file)
-    unique_sources = sorted(list(set(sources)))
+    # Sources are already deduplicated (in case multiple features add the same
+    # source file); sort them for reproducible output.
+    unique_sources = sorted(sources)
 
-    _G.config_mak += "SOURCES = \\\n"
-    for s in unique_sources:
-        _G.config_mak += "   %s \\\n" % s
+    _G.config_mak.write("SOURCES = \\\n")
+    if unique_sources:
+        _G.config_mak.write("   " + " \\\n   ".join(unique_sources) + " \\\n")
 
-    _G.config_mak += "\n"
+    _G.config_mak.write("\n")
 
-    with open(os.path.join(_G.build_dir, "config.mak"), "w") as f:
-        f.write("# Generated by configure.\n\n" + _G.config_mak)
+    _write_file_if_changed(os.path.join(_G.build_dir, "config.mak"),
+                           "# Generated by configure.\n\n" +
+                           _G.config_mak.getvalue())
 
     # Generate build.ninja for Ninja backend (use deduplicated sources)
-    cflags_str = " ".join(_G.cflags) + " " + os.environ.get("CPPFLAGS", "") + " " + os.environ.get("CFLAGS", "")
-    ldflags_str = " ".join(_G.ldflags) + " " + os.environ.get("LDFLAGS", "")
-    ninja_content = _generate_ninja_file(unique_sources, cflags_str.strip(), ldflags_str.strip())
+    cflags_str = " ".join(_G.cflags) + " " + _environ.get("CPPFLAGS", "") + " " + _environ.get("CFLAGS", "")
+    ldflags_str = " ".join(_G.ldflags) + " " + _environ.get("LDFLAGS", "")
+    ninja_parts = _generate_ninja_file(unique_sources, cflags_str.strip(), ldflags_str.strip())
     with open(os.path.join(_G.build_dir, "build.ninja"), "w") as f:
-        f.write(ninja_content)
+        f.writelines(ninja_parts)
 
     if _G.out_of_tree:
         try:
@@ -1164,11 +1566,17 @@ def is_running():
 # this are added as source files if the dependency matches. This stops after
 # the first matching argument.
 def pick_first_matching_dep(*deps):
-    winner = None
-    for e in  deps:
-        if (e[0] == "_" or dep_enabled(e[0])) and (winner is None):
-            # (the odd indirection though winner is so that all dependency
-            #  identifiers are checked for existence)
-            winner = e[1:]
-    if winner is not None:
-        add_sources(*winner)
+    for i, e in enumerate(deps):
+        if e[0] == "_" or dep_enabled(e[0]):
+            add_sources(*e[1:])
+            # (the identifiers after the winner are not evaluated; they are
+            #  only checked for existence at the end of configure)
+            if __debug__:
+                _G.unchecked_deps += [d[0] for d in deps[i + 1:]]
+            return
+
+# Check that all identifiers in ids refer to known dependencies.
+def _validate_dep_ids(ids):
+    for d in ids:
+        if d != "_":
+            dep_enabled(d) # discard result